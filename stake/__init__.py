@@ -0,0 +1 @@
+from .stake import claim, Claim, ClaimError, get_fake_gpu_info, parse_size
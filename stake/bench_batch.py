@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+Compares running a sweep with stake.py --batch against launching one
+stake.py per job, on a fake GPU host (see STAKE_FAKE_GPUS in stake.py).
+
+The sweep is a fixed random mix of jobs that each hold some memory for a few
+seconds.  Reports, for each way of launching it:
+- the makespan (from the first launch to the last job finishing),
+- the largest amount of memory the jobs had in use at once on one GPU, and
+- the GPU-hours of the work (memory-seconds over the size of a GPU), next to
+  the summary from --stats-file for --batch.
+The memory-seconds of the sweep over the capacity of the host give a lower
+bound on the makespan.
+
+Usage:
+
+    # Compare --batch against launching a stake.py every second.
+    bench_batch.py
+
+    # Launch all the individual stake.py at once instead.
+    bench_batch.py --mode individual --interval 0
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from .bench_common import stake_script, record_command, read_records, gpu_mem_seconds, capacity, peak_gpu_mem
+    from . import stake
+except (ImportError, ValueError):
+    # Run as a script
+    from bench_common import stake_script, record_command, read_records, gpu_mem_seconds, capacity, peak_gpu_mem
+    import stake
+
+def make_jobs(args):
+    rand = random.Random(args.seed)
+    return [(rand.choice(args.job_mem), rand.randint(2, 8)) for _ in range(args.num_jobs)]
+
+def run(args, mode, jobs):
+    base_dir = tempfile.mkdtemp(prefix='stake-bench-')
+    env = dict(os.environ, STAKE_FAKE_GPUS=args.gpus, STAKE_HOSTNAME='bench')
+    stake_args = [sys.executable, stake_script, '-b', base_dir]
+    records_path = os.path.join(base_dir, 'records.txt')
+    stats_path = os.path.join(base_dir, 'stats.json')
+    log_file = open(os.path.join(base_dir, 'log'), 'w')
+    processes = []
+    try:
+        start_time = time.time()
+        if mode == 'batch':
+            batch_path = os.path.join(base_dir, 'batch.txt')
+            with open(batch_path, 'w') as f:
+                for gpu_mem, seconds in jobs:
+                    print(gpu_mem, ' '.join(record_command(gpu_mem, seconds, records_path, start_time)), file=f)
+            processes.append(subprocess.Popen(stake_args + ['-s', stats_path, '--batch', batch_path], env=env, stderr=log_file))
+        else:
+            for gpu_mem, seconds in jobs:
+                command = record_command(gpu_mem, seconds, records_path, time.time())
+                processes.append(subprocess.Popen(stake_args + ['-g', gpu_mem, '--'] + command, env=env, stderr=log_file))
+                time.sleep(args.interval)
+        for p in processes:
+            p.wait()
+        end_time = time.time()
+    finally:
+        log_file.close()
+
+    records = read_records(records_path)
+    if len(records) != len(jobs):
+        print('%s: only %d/%d jobs finished, see %s' % (mode, len(records), len(jobs), base_dir))
+        return
+
+    gpu_size = list(stake.get_fake_gpu_info(args.gpus).values())[0]['total_gpu_mem']
+    gpu_hours = gpu_mem_seconds(records, start_time, end_time) / gpu_size / 3600
+    summary = ''
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            summary = ' (--stats-file: %.4f)' % json.load(f)['summary']['gpu_hours']
+    print('%-10s makespan %.1fs; peak %s/GPU; %.4f GPU-hours%s' % \
+        (mode, end_time - start_time, stake.size_str(peak_gpu_mem(records)), gpu_hours, summary))
+    if args.keep:
+        print('%-10s state, records and log in %s' % ('', base_dir))
+    else:
+        shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpus', help='Fake GPUs (<num_gpus>x<size>)', default='8x12g')
+    parser.add_argument('--mode', choices=('batch', 'individual'), action='append', help='Way of launching the jobs to measure (default: all)')
+    parser.add_argument('--num-jobs', type=int, help='Number of jobs in the sweep', default=24)
+    parser.add_argument('--job-mem', nargs='+', help='GPU memory of the jobs to pick from', default=['3g', '4g', '6g', '12g'])
+    parser.add_argument('--seed', type=int, help='Seed for picking the jobs', default=1)
+    parser.add_argument('--interval', type=float, help='Number of seconds between individual launches', default=1)
+    parser.add_argument('--keep', action='store_true', help='Keep the state, records and log of each run')
+    args = parser.parse_args()
+
+    jobs = make_jobs(args)
+    work = sum(stake.parse_size(gpu_mem) * seconds for gpu_mem, seconds in jobs)
+    print('%d jobs, makespan lower bound %.1fs' % (len(jobs), work / capacity(args.gpus, 1)))
+    for mode in args.mode or ('batch', 'individual'):
+        run(args, mode, jobs)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''
+Pieces shared by the bench_*.py drivers, which run stake on a fake GPU host
+(see STAKE_FAKE_GPUS in stake.py).
+
+The jobs that the drivers launch run this script:
+
+    bench_common.py record <gpu_mem> <seconds> <path> <launch_time>
+
+which sleeps, then appends a line describing the work that got done to path
+(see read_records).
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+from stake import get_fake_gpu_info, parse_size
+
+stake_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stake.py')
+
+def record(gpu_mem, seconds, path, launch_time):
+    start_time = time.time()
+    time.sleep(float(seconds))
+    write_record(path, gpu_mem, start_time, time.time(), launch_time)
+
+def write_record(path, gpu_mem, start_time, end_time, launch_time):
+    with open(path, 'a') as f:
+        print(os.environ.get('CUDA_VISIBLE_DEVICES'), gpu_mem, start_time, end_time, launch_time, file=f)
+
+def record_command(gpu_mem, seconds, path, launch_time):
+    return [sys.executable, os.path.abspath(__file__), 'record', str(parse_size(gpu_mem)), str(seconds), path, str(launch_time)]
+
+def read_records(path):
+    if not os.path.exists(path):
+        return []
+    records = []
+    for line in open(path):
+        gpu, gpu_mem, start_time, end_time, launch_time = line.split()
+        records.append({'gpu': gpu, 'gpu_mem': float(gpu_mem), 'start_time': float(start_time), 'end_time': float(end_time), 'launch_time': float(launch_time)})
+    return records
+
+def gpu_mem_seconds(records, start_time, end_time):
+    '''
+    Return the memory-seconds of the work in records done between start_time
+    and end_time.
+    '''
+    return sum(r['gpu_mem'] * max(0, min(r['end_time'], end_time) - max(r['start_time'], start_time)) for r in records)
+
+def capacity(gpus, seconds):
+    '''
+    Return the memory-seconds that the fake GPUs (<num_gpus>x<size>) offer in
+    the given number of seconds.
+    '''
+    return sum(info['total_gpu_mem'] for info in get_fake_gpu_info(gpus).values()) * seconds
+
+def peak_gpu_mem(records):
+    '''
+    Return the largest amount of memory that the records had in use at once
+    on a single GPU.
+    '''
+    events = sorted([(r['start_time'], r['gpu_mem'], r['gpu']) for r in records] +
+                    [(r['end_time'], -r['gpu_mem'], r['gpu']) for r in records])
+    usage = {}
+    peak = 0
+    for _, gpu_mem, gpu in events:
+        usage[gpu] = usage.get(gpu, 0) + gpu_mem
+        peak = max(peak, usage[gpu])
+    return peak
+
+if __name__ == '__main__':
+    if len(sys.argv) != 6 or sys.argv[1] != 'record':
+        print('Usage: %s record <gpu_mem> <seconds> <path> <launch_time>' % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    record(*sys.argv[2:])
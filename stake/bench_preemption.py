@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+'''
+Measures preemption on a fake GPU host (see STAKE_FAKE_GPUS in stake.py).
+
+A stream of normal jobs arrives at a fixed interval while, optionally, a
+--batch of long backfill jobs soaks up the rest of the host with either
+preemptible or normal claims.  Reports, for each kind of backfill:
+- time-to-placement of the normal jobs (from launching stake.py to the
+  command starting), and
+- GPU memory utilization: memory-seconds of completed work over the
+  capacity of the host, from the start until the last normal job finishes
+  (work lost to preemption does not count).
+
+Usage:
+
+    # Compare no backfill, preemptible backfill and normal backfill.
+    bench_preemption.py
+
+    # Only preemptible backfill, on 8 GPUs.
+    bench_preemption.py --gpus 8x24g --backfill preemptible
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from .bench_common import stake_script, record_command, read_records, gpu_mem_seconds, capacity
+except (ImportError, ValueError):
+    # Run as a script
+    from bench_common import stake_script, record_command, read_records, gpu_mem_seconds, capacity
+
+def run(args, backfill):
+    base_dir = tempfile.mkdtemp(prefix='stake-bench-')
+    env = dict(os.environ, STAKE_FAKE_GPUS=args.gpus, STAKE_HOSTNAME='bench')
+    stake_args = [sys.executable, stake_script, '-b', base_dir, '--grace-period', str(args.grace_period)]
+    normal_path = os.path.join(base_dir, 'normal.txt')
+    backfill_path = os.path.join(base_dir, 'backfill.txt')
+    log_file = open(os.path.join(base_dir, 'log'), 'w')
+    processes = []
+    try:
+        start_time = time.time()
+        if backfill != 'none':
+            batch_path = os.path.join(base_dir, 'batch.txt')
+            with open(batch_path, 'w') as f:
+                for _ in range(args.backfill_jobs):
+                    print(args.backfill_mem, ' '.join(record_command(args.backfill_mem, args.backfill_time, backfill_path, 0)), file=f)
+            processes.append(subprocess.Popen(stake_args + ['--priority', backfill, '--batch', batch_path], env=env, stderr=log_file))
+            # Let the backfill fill up the host
+            time.sleep(2)
+
+        for _ in range(args.num_jobs):
+            command = record_command(args.job_mem, args.job_time, normal_path, time.time())
+            processes.append(subprocess.Popen(stake_args + ['-g', args.job_mem, '--'] + command, env=env, stderr=log_file))
+            time.sleep(args.interval)
+
+        # Wait for the normal jobs, then stop the backfill
+        for p in processes[1 if backfill != 'none' else 0:]:
+            p.wait()
+        end_time = time.time()
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+                p.wait()
+    finally:
+        log_file.close()
+
+    normal_records = read_records(normal_path)
+    backfill_records = read_records(backfill_path)
+    if len(normal_records) != args.num_jobs:
+        print('%s: only %d/%d normal jobs finished, see %s' % (backfill, len(normal_records), args.num_jobs, base_dir))
+        return
+
+    total = capacity(args.gpus, end_time - start_time)
+    normal_work = gpu_mem_seconds(normal_records, start_time, end_time)
+    backfill_work = gpu_mem_seconds(backfill_records, start_time, end_time)
+    waits = [r['start_time'] - r['launch_time'] for r in normal_records]
+    print('%-12s time-to-placement mean %.1fs max %.1fs; utilization %.0f%% (normal jobs %.0f%%) over %.0fs' % \
+        (backfill, sum(waits) / len(waits), max(waits),
+         100 * (normal_work + backfill_work) / total, 100 * normal_work / total, end_time - start_time))
+    if args.keep:
+        print('%-12s state, records and log in %s' % ('', base_dir))
+    else:
+        shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpus', help='Fake GPUs (<num_gpus>x<size>)', default='4x24g')
+    parser.add_argument('--backfill', choices=('none', 'preemptible', 'normal'), action='append', help='Kind of backfill to measure (default: all)')
+    parser.add_argument('--grace-period', type=int, help='Grace period of preempted claims', default=2)
+    parser.add_argument('--num-jobs', type=int, help='Number of normal jobs', default=12)
+    parser.add_argument('--interval', type=float, help='Number of seconds between normal jobs', default=2)
+    parser.add_argument('--job-mem', help='GPU memory of each normal job', default='20g')
+    parser.add_argument('--job-time', type=float, help='Number of seconds each normal job runs', default=5)
+    parser.add_argument('--backfill-jobs', type=int, help='Number of backfill jobs', default=40)
+    parser.add_argument('--backfill-mem', help='GPU memory of each backfill job', default='4g')
+    parser.add_argument('--backfill-time', type=float, help='Number of seconds each backfill job runs', default=15)
+    parser.add_argument('--keep', action='store_true', help='Keep the state, records and log of each run')
+    args = parser.parse_args()
+
+    for backfill in args.backfill or ('none', 'preemptible', 'normal'):
+        run(args, backfill)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Measures what resizing claims from Python (stake.claim) buys for jobs whose
+memory needs vary by phase, on a fake GPU host (see STAKE_FAKE_GPUS in
+stake.py).
+
+Each phase job first needs --low-mem for --low-time seconds, then --high-mem
+for --high-time seconds.  It either claims --high-mem for its whole run
+(static), or claims --low-mem with max_gpu_mem=--high-mem and resizes when it
+gets to the second phase (dynamic).  Small co-tenant jobs arrive
+--small-delay seconds later and take whatever room is left.  Reports, for each way of claiming:
+- the makespan (from the start until all jobs finish), and
+- GPU memory utilization: memory-seconds that the jobs actually needed over
+  the capacity of the host during the makespan.
+
+Usage:
+
+    # Compare static and dynamic claims.
+    bench_resize.py
+
+    # Only dynamic claims, with more co-tenants.
+    bench_resize.py --mode dynamic --num-small-jobs 80
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from .bench_common import write_record, read_records, gpu_mem_seconds, capacity
+    from . import stake
+except (ImportError, ValueError):
+    # Run as a script
+    from bench_common import write_record, read_records, gpu_mem_seconds, capacity
+    import stake
+
+def job(mode, path, base_dir, start_time, *phases):
+    '''
+    The jobs that the driver launches: wait until start_time, claim memory in
+    the given mode, and go through the phases (<gpu_mem> <seconds> ...),
+    appending a record for each.
+    '''
+    time.sleep(max(0, float(start_time) - time.time()))
+    phases = [(stake.parse_size(phases[i]), float(phases[i + 1])) for i in range(0, len(phases), 2)]
+    peak_gpu_mem = max(gpu_mem for gpu_mem, _ in phases)
+    if mode == 'static' or peak_gpu_mem == phases[0][0]:
+        c = stake.claim(gpu_mem=peak_gpu_mem, wait_time=1000, base_dir=base_dir)
+    else:
+        c = stake.claim(gpu_mem=phases[0][0], max_gpu_mem=peak_gpu_mem, wait_time=1000, base_dir=base_dir)
+    os.environ['CUDA_VISIBLE_DEVICES'] = c.cuda_visible_devices
+    with c:
+        for gpu_mem, seconds in phases:
+            if mode == 'dynamic' and gpu_mem > c.gpu_mem:
+                c.resize(gpu_mem, wait_time=1000)
+            phase_start_time = time.time()
+            time.sleep(seconds)
+            write_record(path, gpu_mem, phase_start_time, time.time(), start_time)
+
+def run(args, mode):
+    base_dir = tempfile.mkdtemp(prefix='stake-bench-')
+    env = dict(os.environ, STAKE_FAKE_GPUS=args.gpus, STAKE_HOSTNAME='bench')
+    records_path = os.path.join(base_dir, 'records.txt')
+    log_file = open(os.path.join(base_dir, 'log'), 'w')
+    job_args = [sys.executable, os.path.abspath(__file__), 'job']
+    # Give all the jobs time to start up, so that they compete from the same point.
+    start_time = time.time() + 2
+    processes = []
+    try:
+        for _ in range(args.num_phase_jobs):
+            phases = [args.low_mem, str(args.low_time), args.high_mem, str(args.high_time)]
+            processes.append(subprocess.Popen(job_args + [mode, records_path, base_dir, str(start_time)] + phases, env=env, stderr=log_file))
+        small_start_time = start_time + args.small_delay
+        for _ in range(args.num_small_jobs):
+            phases = [args.small_mem, str(args.small_time)]
+            processes.append(subprocess.Popen(job_args + [mode, records_path, base_dir, str(small_start_time)] + phases, env=env, stderr=log_file))
+        for p in processes:
+            p.wait()
+        end_time = time.time()
+    finally:
+        log_file.close()
+
+    records = read_records(records_path)
+    num_records = 2 * args.num_phase_jobs + args.num_small_jobs
+    if len(records) != num_records:
+        print('%s: only %d/%d phases finished, see %s' % (mode, len(records), num_records, base_dir))
+        return
+
+    print('%-8s makespan %.1fs; utilization %.0f%%' % \
+        (mode, end_time - start_time, 100 * gpu_mem_seconds(records, start_time, end_time) / capacity(args.gpus, end_time - start_time)))
+    if args.keep:
+        print('%-8s state, records and log in %s' % ('', base_dir))
+    else:
+        shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'job':
+        job(*sys.argv[2:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpus', help='Fake GPUs (<num_gpus>x<size>)', default='4x24g')
+    parser.add_argument('--mode', choices=('static', 'dynamic'), action='append', help='Way of claiming to measure (default: all)')
+    parser.add_argument('--num-phase-jobs', type=int, help='Number of jobs with two phases', default=4)
+    parser.add_argument('--low-mem', help='GPU memory of the first phase', default='4g')
+    parser.add_argument('--low-time', type=float, help='Number of seconds of the first phase', default=6)
+    parser.add_argument('--high-mem', help='GPU memory of the second phase', default='20g')
+    parser.add_argument('--high-time', type=float, help='Number of seconds of the second phase', default=2)
+    parser.add_argument('--num-small-jobs', type=int, help='Number of co-tenant jobs', default=40)
+    parser.add_argument('--small-mem', help='GPU memory of each co-tenant job', default='4g')
+    parser.add_argument('--small-delay', type=float, help='Number of seconds after the phase jobs that the co-tenant jobs arrive', default=1)
+    parser.add_argument('--small-time', type=float, help='Number of seconds each co-tenant job runs', default=3)
+    parser.add_argument('--keep', action='store_true', help='Keep the state, records and log of each run')
+    args = parser.parse_args()
+
+    for mode in args.mode or ('static', 'dynamic'):
+        run(args, mode)
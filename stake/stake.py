@@ -18,26 +18,66 @@ Usage:
     # Outputs run statistics to run-stats.json.
     stake.py -g 5g -s run-stats.json python main.py
 
+    # Put '--' before commands that take options of their own.
+    stake.py -g 5g -- python main.py -p 3
+
+    # Soak up idle memory, but give it back to normal claims when they need it:
+    # the command gets SIGTERM, then SIGKILL 60 seconds later.
+    stake.py -g 5g --priority preemptible python main.py
+    stake.py -g 20g --grace-period 60 python main.py
+
+    # Run the commands in jobs.txt (one '<gpu_mem> <command>' per line),
+    # as many at once as fit on the GPUs.  Outputs per-job stats and a summary
+    # to sweep-stats.json.
+    stake.py --batch jobs.txt -s sweep-stats.json
+
+    # Prints the last sample if it is at most 30 seconds old (does not run nvidia-smi).
+    stake.py --cached 30
+
+Claims can also be made from within a Python program; they belong to the
+calling process and can be resized or released while it runs:
+
+    import stake
+    with stake.claim(gpu_mem='4g', max_gpu_mem='20g') as c:
+        os.environ['CUDA_VISIBLE_DEVICES'] = c.cuda_visible_devices
+        preprocess()
+        c.resize('20g')
+        evaluate()
+
+The hostname used to name the state file is resolved once and cached under
+the base directory; set STAKE_HOSTNAME to override it.
+
 @author Percy Liang
 '''
 from __future__ import print_function
-from builtins import str
-from builtins import map
-from builtins import range
 
 import argparse
 import json
 import os
-import random
 import re
-import socket
-import string
-import subprocess
 import sys
-import shlex
-import signal
 import time
 
+if sys.version_info[0] < 3:
+    from builtins import str
+    from builtins import map
+    from builtins import range
+
+# Note: subprocess, socket, signal, random, string and threading are imported
+# where they are used so that read-only queries (e.g., --cached) start up quickly.
+
+DEFAULT_BASE_DIR = '/u/nlp/machine-info/stake/var'
+
+# Normal claims can preempt preemptible ones when they do not fit.
+PRIORITIES = ('normal', 'preemptible')
+DEFAULT_GRACE_PERIOD = 30
+
+# Path to the JSON file with the state of this machine (see init_stake_path).
+stake_path = None
+
+class ClaimError(Exception):
+    pass
+
 def log(s):
     print('[stake %s] %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), s), file=sys.stderr)
 
@@ -105,6 +145,11 @@ def get_gpu_info():
         assert s.endswith('MiB')
         return int(s[:-3]) * 1024 * 1024
 
+    fake_gpus = os.environ.get('STAKE_FAKE_GPUS')
+    if fake_gpus:
+        return get_fake_gpu_info(fake_gpus)
+
+    import subprocess
     lines = subprocess.check_output('nvidia-smi').decode('utf-8').split('\n')
     curr_gpu_num = None
     in_processes_section = False
@@ -139,40 +184,158 @@ def get_gpu_info():
         #print line
     return info
 
+def get_fake_gpu_info(spec):
+    '''
+    spec: <num_gpus>x<size> (e.g., 8x12g)
+    Return the same structure as get_gpu_info() for idle GPUs, so that stake
+    can be exercised on machines without nvidia-smi.
+    '''
+    num_gpus, total_gpu_mem = spec.split('x')
+    total_gpu_mem = int(parse_size(total_gpu_mem))
+    return dict((gpu_num, {'free_gpu_mem': 0, 'total_gpu_mem': total_gpu_mem}) for gpu_num in range(int(num_gpus)))
+
 ############################################################
 
+def get_hostname(base_dir):
+    '''
+    Return the short hostname, which names the state file.
+    Resolving it requires a DNS lookup, so cache the result under base_dir
+    (keyed on the local hostname).  STAKE_HOSTNAME overrides everything.
+    '''
+    hostname = os.environ.get('STAKE_HOSTNAME')
+    if hostname:
+        return hostname
+
+    # Same as socket.gethostname(), without importing socket
+    local_hostname = os.uname()[1]
+    cache_path = os.path.join(base_dir, 'hostnames', local_hostname)
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            hostname = f.read().strip()
+        if hostname:
+            return hostname
+
+    import socket
+    hostname = socket.gethostbyaddr(local_hostname)[0].split('.')[0]
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as f:
+            print(hostname, file=f)
+    except (IOError, OSError) as e:
+        log('Unable to cache hostname in %s: %s' % (cache_path, e))
+    return hostname
+
+def init_stake_path(base_dir):
+    global stake_path
+    stake_path = os.path.join(base_dir, get_hostname(base_dir) + '.json')
+    return stake_path
+
+class StakeLock(object):
+    '''
+    Exclusive lock on the state file; hold it from reading the claims to
+    writing them back so that concurrent updates are not lost.
+    '''
+    def __enter__(self):
+        import fcntl
+        self.lock_file = open(stake_path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock_file.close()
+
 def read_stake_info():
     if not os.path.exists(stake_path):
         return {}
-    return json.load(open(stake_path))
+    stake_info = json.load(open(stake_path))
+    # JSON turns the GPU numbers into strings
+    if 'gpu_info' in stake_info:
+        stake_info['gpu_info'] = dict((int(gpu_num), info) for gpu_num, info in stake_info['gpu_info'].items())
+    return stake_info
 
 def write_stake_info(stake_info):
-    with open(stake_path, 'w') as f:
+    # Write to a temporary file and rename so that readers never see a partial file.
+    tmp_path = '%s.%d.tmp' % (stake_path, os.getpid())
+    with open(tmp_path, 'w') as f:
         print(json.dumps(stake_info), file=f)
+    os.rename(tmp_path, stake_path)
 
 def claim_exists(claim):
     pid = claim.get('pid')
-    return pid is not None and os.path.exists('/proc/' + str(pid))
+    if pid is None:
+        return False
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return False
+    # Zombies (exited but not yet reaped) don't hold any resources.
+    return stat[stat.rindex(')') + 2:].split()[0] != 'Z'
 
 def read_update_stake_info():
-    stake_info = read_stake_info()
+    # Sample outside of the lock since nvidia-smi is slow
+    gpu_info = get_gpu_info()
+    gpu_info_time = time.time()
 
-    # Update GPU info
-    stake_info['gpu_info'] = get_gpu_info()
+    with StakeLock():
+        stake_info = read_stake_info()
 
-    # Delete claims which are no longer there
-    stake_info['claims'] = [claim for claim in stake_info.get('claims', []) if claim_exists(claim)]
+        # Update GPU info
+        stake_info['gpu_info'] = gpu_info
+        stake_info['gpu_info_time'] = gpu_info_time
+
+        # Delete claims and reservations which are no longer there
+        stake_info['claims'] = [claim for claim in stake_info.get('claims', []) if claim_exists(claim)]
+        stake_info['reservations'] = [reservation for reservation in stake_info.get('reservations', []) if claim_exists(reservation)]
 
-    write_stake_info(stake_info)
+        # Stop preempting claims for reservations that are gone
+        reservation_ids = set(reservation['reservation_id'] for reservation in stake_info['reservations'])
+        for claim in stake_info['claims']:
+            if 'preempted_for' in claim and claim['preempted_for'] not in reservation_ids:
+                del claim['preempt_deadline'], claim['preempted_for']
+
+        write_stake_info(stake_info)
     return stake_info
 
+def refresh_claims(stake_info):
+    # Call with the lock held: picks up claims (and reservations) made by others since stake_info was read.
+    latest_stake_info = read_stake_info()
+    stake_info['claims'] = latest_stake_info.get('claims', [])
+    stake_info['reservations'] = latest_stake_info.get('reservations', [])
+
+def update_claim(stake_info, claim_id, **fields):
+    '''
+    Set fields of the claim in the state file.
+    Return the updated claim.
+    '''
+    with StakeLock():
+        refresh_claims(stake_info)
+        claim = get_claim(stake_info, claim_id)
+        claim.update(fields)
+        write_stake_info(stake_info)
+    return claim
+
 def generate_claim_id():
+    import random
+    import string
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
 
+def get_parent_pid(pid):
+    # Reading /proc is much cheaper than spawning ps.
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        # The process is gone
+        return 1
+    # The command name (in parentheses) can contain spaces.
+    return int(stat[stat.rindex(')') + 2:].split()[1])
+
 def is_pid_under(parent_pid, child_pid):
     # Walk up the process tree
-    while child_pid != 1 and child_pid != parent_pid:
-        child_pid = int(os.popen("ps -p %d -oppid=" % child_pid).read().strip())
+    while child_pid > 1 and child_pid != parent_pid:
+        child_pid = get_parent_pid(child_pid)
     return parent_pid == child_pid
 
 def join_process_claims(stake_info, gpu_num):
@@ -196,16 +359,18 @@ def join_process_claims(stake_info, gpu_num):
         result.append(info)
 
     for process in processes:
-        if processes in claimed_processes:
+        if process in claimed_processes:
             continue
         info = {'process': process}
         result.append(info)
     return result
 
-def available_gpu_mem(stake_info, gpu_num):
+def available_gpu_mem(stake_info, gpu_num, reservation_id=None):
     '''
     available memory means not used by a process or claimed.
     In general, take the max over the two.
+    Memory reserved for claims waiting on preemption (other than
+    reservation_id) is not available either.
     '''
     items = join_process_claims(stake_info, gpu_num)
     unavailable_gpu_mem = 0
@@ -213,6 +378,9 @@ def available_gpu_mem(stake_info, gpu_num):
         m1 = item.get('process', {}).get('gpu_mem', 0)
         m2 = item.get('claim', {}).get('gpu_mem', 0)
         unavailable_gpu_mem += max(m1, m2)
+    for reservation in stake_info.get('reservations', []):
+        if reservation['gpu_num'] == gpu_num and reservation['reservation_id'] != reservation_id:
+            unavailable_gpu_mem += reservation['gpu_mem']
     return stake_info['gpu_info'][gpu_num]['total_gpu_mem'] - unavailable_gpu_mem
 
 def get_claimed_gpu_mem(stake_info, gpu_num):
@@ -222,37 +390,198 @@ def get_claimed_gpu_mem(stake_info, gpu_num):
             claimed_gpu_mem += claim['gpu_mem']
     return claimed_gpu_mem
 
-def make_claim(stake_info):
+def get_max_claimed_gpu_mem(stake_info, gpu_num):
+    # Claims that expect to grow count with their maximum.
+    max_claimed_gpu_mem = 0
+    for claim in stake_info.get('claims', []):
+        if claim['gpu_num'] == gpu_num:
+            max_claimed_gpu_mem += max(claim['gpu_mem'], claim.get('max_gpu_mem', 0))
+    return max_claimed_gpu_mem
+
+def make_claim(stake_info, gpu_mem, command, pid=None, max_gpu_mem=None, priority='normal', reservation_id=None):
     '''
+    gpu_mem: number of bytes
+    pid: process the claim belongs to (defaults to this one)
+    max_gpu_mem: number of bytes the claim might grow to; only put it on a GPU
+    where it can grow alongside the other growing claims.
+    priority: one of PRIORITIES
+    reservation_id: memory reserved for this claim by preempt_claims() is
+    available to it, and the reservation is dropped once it is placed.
     Return the claim_id.
     '''
-    gpu_mem = parse_size(args.gpu_mem)
+    with StakeLock():
+        refresh_claims(stake_info)
 
-    # Go over the GPUs and find a free one
-    for gpu_num in sorted(stake_info['gpu_info'].keys()):
-        info = stake_info['gpu_info'][gpu_num]
-        total_gpu_mem = info['total_gpu_mem']
+        # Go over the GPUs and find a free one
+        for gpu_num in sorted(stake_info['gpu_info'].keys()):
+            info = stake_info['gpu_info'][gpu_num]
+            total_gpu_mem = info['total_gpu_mem']
+
+            # See if we can put it on this GPU
+            if gpu_mem > available_gpu_mem(stake_info, gpu_num, reservation_id):
+                continue
+            if max_gpu_mem and max_gpu_mem > total_gpu_mem - get_max_claimed_gpu_mem(stake_info, gpu_num):
+                continue
+
+            # Create a claim
+            claim_id = generate_claim_id()
+            claim = {
+                'claim_id': claim_id,
+                'gpu_num': gpu_num,
+                'gpu_mem': gpu_mem,
+                'command': command,
+                'start_date': time.time(),
+                'pid': pid or os.getpid(),
+                'priority': priority,
+            }
+            if max_gpu_mem:
+                claim['max_gpu_mem'] = max_gpu_mem
+            stake_info['claims'].append(claim)
+            if reservation_id:
+                drop_reservation(stake_info, reservation_id)
+            write_stake_info(stake_info)
+            break
+        else:
+            return None
+
+    log('claim %s taking %s memory on GPU%s (%s), where %s/%s is available' % \
+        (claim_id, size_str(gpu_mem), gpu_num, priority, size_str(available_gpu_mem(stake_info, gpu_num)), size_str(total_gpu_mem)))
+    return claim_id
+
+def drop_reservation(stake_info, reservation_id):
+    '''
+    Call with the lock held: remove the reservation and stop preempting the
+    claims preempted for it.
+    '''
+    stake_info['reservations'] = [reservation for reservation in stake_info.get('reservations', []) if reservation['reservation_id'] != reservation_id]
+    for claim in stake_info.get('claims', []):
+        if claim.get('preempted_for') == reservation_id:
+            del claim['preempt_deadline'], claim['preempted_for']
+
+def cancel_reservation(stake_info, reservation_id):
+    '''
+    Give up on a reservation made by preempt_claims().
+    '''
+    with StakeLock():
+        refresh_claims(stake_info)
+        if any(reservation['reservation_id'] == reservation_id for reservation in stake_info['reservations']):
+            drop_reservation(stake_info, reservation_id)
+            write_stake_info(stake_info)
+            log('Gave up on reservation %s, no longer preempting claims for it' % reservation_id)
+
+def find_preemptible_claims(stake_info, gpu_mem, reservation_id, gpu_nums=None):
+    '''
+    Return (gpu_num, claims), where claims is the smallest set of preemptible
+    claims on one of gpu_nums (default: all GPUs) whose release makes room for
+    gpu_mem, or (None, None).  Claims already being preempted for
+    reservation_id count as released, so claims can be empty if enough is
+    already on its way.  GPUs where nothing would be preempted for
+    reservation_id are skipped: if gpu_mem fits there already, preempting
+    does not help.
+    '''
+    best_gpu_num, best_claims, best_freed_gpu_mem, best_lost_time = None, None, None, None
+    for gpu_num in sorted(gpu_nums or stake_info['gpu_info'].keys()):
+        needed_gpu_mem = gpu_mem - available_gpu_mem(stake_info, gpu_num, reservation_id)
+        on_its_way = False
+        candidates = []
+        for item in join_process_claims(stake_info, gpu_num):
+            claim = item.get('claim')
+            if not claim or claim.get('priority') != 'preemptible':
+                continue
+            freed_gpu_mem = max(item.get('process', {}).get('gpu_mem', 0), claim['gpu_mem'])
+            if claim.get('preempted_for') == reservation_id:
+                needed_gpu_mem -= freed_gpu_mem
+                on_its_way = True
+            elif 'preempt_deadline' not in claim:
+                candidates.append((freed_gpu_mem, claim))
 
-        # See if we can put it on this GPU
-        if gpu_mem > available_gpu_mem(stake_info, gpu_num):
+        # Releasing the biggest claims first takes the fewest claims;
+        # among equal ones, the youngest have the least work to lose
+        candidates.sort(key=lambda candidate: (-candidate[0], -candidate[1]['start_date']))
+        claims = []
+        freed_gpu_mem = 0
+        for candidate_gpu_mem, claim in candidates:
+            if freed_gpu_mem >= needed_gpu_mem:
+                break
+            claims.append(claim)
+            freed_gpu_mem += candidate_gpu_mem
+        if freed_gpu_mem < needed_gpu_mem or not (claims or on_its_way):
             continue
 
-        # Create a claim
-        claim_id = generate_claim_id()
-        claim = {
-            'claim_id': claim_id,
-            'gpu_num': gpu_num,
-            'gpu_mem': gpu_mem,
-            'command': args.command,
-            'start_date': time.time(),
-        }
-        stake_info.setdefault('claims', []).append(claim)
+        # Prefer fewer claims, then less memory taken away, then less work lost
+        lost_time = sum(time.time() - claim['start_date'] for claim in claims)
+        if best_claims is None or (len(claims), freed_gpu_mem, lost_time) < (len(best_claims), best_freed_gpu_mem, best_lost_time):
+            best_gpu_num, best_claims, best_freed_gpu_mem, best_lost_time = gpu_num, claims, freed_gpu_mem, lost_time
+    return best_gpu_num, best_claims
+
+def preempt_claims(stake_info, gpu_mem, grace_period, reservation_id):
+    '''
+    Ask the smallest set of preemptible claims to make room for gpu_mem within
+    grace_period seconds: their supervisors send their commands SIGTERM and
+    then SIGKILL at the deadline.  The room is reserved (for this process)
+    under reservation_id until make_claim() places the claim or
+    cancel_reservation() gives up.  Also kill (where permitted) the processes
+    of claims that are past their deadline.
+    Return whether room is being made.
+    '''
+    import signal
+
+    with StakeLock():
+        refresh_claims(stake_info)
+        reservations = [reservation for reservation in stake_info['reservations'] if reservation['reservation_id'] == reservation_id]
+
+        # Keep making room on the GPU where it is reserved, if possible
+        gpu_num, claims = None, None
+        if reservations:
+            gpu_num, claims = find_preemptible_claims(stake_info, gpu_mem, reservation_id, [reservations[0]['gpu_num']])
+            if gpu_num is None:
+                drop_reservation(stake_info, reservation_id)
+                reservations = []
+        if gpu_num is None:
+            gpu_num, claims = find_preemptible_claims(stake_info, gpu_mem, reservation_id)
+
+        if gpu_num is not None:
+            if claims:
+                deadline = time.time() + grace_period
+                for claim in claims:
+                    claim['preempt_deadline'] = deadline
+                    claim['preempted_for'] = reservation_id
+            if not reservations:
+                stake_info['reservations'].append({
+                    'reservation_id': reservation_id,
+                    'gpu_num': gpu_num,
+                    'gpu_mem': gpu_mem,
+                    'pid': os.getpid(),
+                    'start_date': time.time(),
+                })
         write_stake_info(stake_info)
 
-        log('claim %s taking %s memory on GPU%s, where %s/%s is available' % \
-            (claim_id, size_str(gpu_mem), gpu_num, size_str(available_gpu_mem(stake_info, gpu_num)), size_str(total_gpu_mem)))
+    if claims:
+        log('Preempting %d claims on GPU%s to make room for %s (reservation %s, grace period %ds): %s' % \
+            (len(claims), gpu_num, size_str(gpu_mem), reservation_id, grace_period, ', '.join('%s (%s, pid %s)' % (claim['claim_id'], size_str(claim['gpu_mem']), claim['pid']) for claim in claims)))
+
+    for claim in stake_info['claims']:
+        if time.time() >= claim.get('preempt_deadline', float('inf')) and claim_exists(claim):
+            try:
+                os.kill(claim['pid'], signal.SIGKILL)
+            except OSError:
+                pass
+    return gpu_num is not None
+
+def can_wait_for_preemption(end_time, grace_period):
+    # Preempted claims are gone a tick or two after their deadline.
+    return time.time() + grace_period + 2 < end_time
 
-        return claim_id
+def preemption_signal(stake_info, claim_id):
+    '''
+    Return the signal to send to the command of a claim that is being
+    preempted (SIGTERM, or SIGKILL once the grace period is over), or None.
+    '''
+    import signal
+
+    for claim in stake_info.get('claims', []):
+        if claim['claim_id'] == claim_id and 'preempt_deadline' in claim:
+            return signal.SIGKILL if time.time() >= claim['preempt_deadline'] else signal.SIGTERM
     return None
 
 def get_claim(stake_info, claim_id):
@@ -261,7 +590,31 @@ def get_claim(stake_info, claim_id):
             return claim
     raise Exception('Internal error')
 
+def find_process(stake_info, gpu_num, pid):
+    '''
+    Return the process on the GPU running under pid (or None).
+    '''
+    for process in stake_info['gpu_info'][gpu_num].get('processes', []):
+        if is_pid_under(pid, process['pid']):
+            return process
+    return None
+
+def enforce_claim(stake_info, claim, pid):
+    '''
+    Find the GPU process running under pid and kill it if it uses more memory
+    than claimed.  Return the process (or None).
+    '''
+    import signal
+
+    process = find_process(stake_info, claim['gpu_num'], pid)
+    if process and process['gpu_mem'] > claim['gpu_mem']:
+        log('GPU memory usage %s exceeded claim %s, killing process %d and %d' % (size_str(process['gpu_mem']), size_str(claim['gpu_mem']), pid, process['pid']))
+        os.kill(process['pid'], signal.SIGTERM)
+    return process
+
 def run_command(claim_id, stake_info):
+    import subprocess
+
     claim = get_claim(stake_info, claim_id)
 
     command = claim['command']
@@ -275,10 +628,10 @@ def run_command(claim_id, stake_info):
     log('Running as pid %d: %s' % (p.pid, ' '.join(command)))
     start_time = time.time()
 
-    claim['pid'] = p.pid
-    write_stake_info(stake_info)
+    claim = update_claim(stake_info, claim_id, pid=p.pid)
     process = None
     max_gpu_mem = 0
+    last_signal = None
 
     def output_stats():
         stats = {
@@ -304,22 +657,17 @@ def run_command(claim_id, stake_info):
         first = False
 
         stake_info = read_update_stake_info()
-        gpu_mem = None
 
         # Associate process with claim
-        processes = stake_info['gpu_info'][claim['gpu_num']].get('processes', [])
-        process = None
-        for proc in processes:
-            if is_pid_under(p.pid, proc['pid']):
-                process = proc
-                max_gpu_mem = max(max_gpu_mem, proc['gpu_mem'])
-                break
-
+        process = enforce_claim(stake_info, claim, p.pid)
         if process:
-            if process['gpu_mem'] > claim['gpu_mem']:
-                log('GPU memory usage %s exceeded claim %s, killing process %d and %d' % (size_str(process['gpu_mem']), size_str(claim['gpu_mem']), p.pid, process['pid']))
-                os.kill(process['pid'], signal.SIGTERM)
-                #p.terminate()
+            max_gpu_mem = max(max_gpu_mem, process['gpu_mem'])
+
+        sig = preemption_signal(stake_info, claim_id)
+        if sig and sig != last_signal:
+            log('claim %s is being preempted, sending signal %d to process %d' % (claim_id, sig, p.pid))
+            os.kill(p.pid, sig)
+            last_signal = sig
 
         output_stats()
 
@@ -327,21 +675,184 @@ def run_command(claim_id, stake_info):
     output_stats()
     sys.exit(p.returncode)
 
-def do_create():
-    # Claim some resources
+def wait_for_claim(gpu_mem, command, wait_time, pid=None, max_gpu_mem=None, priority='normal', grace_period=DEFAULT_GRACE_PERIOD):
+    '''
+    Keep trying to make a claim for up to wait_time seconds.  If this one is
+    normal, preempt preemptible claims, but only if it will still be waiting
+    when they have to be gone.  Claims with a max_gpu_mem do not preempt:
+    preempting only makes room for gpu_mem, not for growing to max_gpu_mem.
+    Return (claim_id, stake_info); claim_id is None if nothing freed up.
+    '''
     start_time = time.time()
+    reservation_id = generate_claim_id()
+    preempt_time = None
     first_time = True
-    while time.time() - start_time < args.wait_time:
+    claim_id = None
+    stake_info = None
+    while time.time() - start_time < wait_time or stake_info is None:
         stake_info = read_update_stake_info()
-        claim_id = make_claim(stake_info)
+        claim_id = make_claim(stake_info, gpu_mem, command, pid, max_gpu_mem, priority, reservation_id)
         if claim_id:
+            if preempt_time is not None:
+                log('claim %s placed %.1fs after preempting (%.1fs after asking)' % (claim_id, time.time() - preempt_time, time.time() - start_time))
             break
-        if args.wait_time > 0:
+        if priority == 'normal' and not max_gpu_mem and can_wait_for_preemption(start_time + wait_time, grace_period) and \
+                preempt_claims(stake_info, gpu_mem, grace_period, reservation_id):
+            if preempt_time is None:
+                preempt_time = time.time()
+            time.sleep(1)
+            continue
+        if wait_time > 0:
             if first_time:
                 log('Waiting for something to free up...')
                 first_time = False
             time.sleep(1)
+    if not claim_id and preempt_time is not None:
+        cancel_reservation(stake_info, reservation_id)
+    return claim_id, stake_info
+
+############################################################
+# Python API
+
+class Claim(object):
+    '''
+    A claim held by the calling process (see claim()).
+    When used as a context manager, the claim is released on exit.
+    '''
+    def __init__(self, claim_id, gpu_num, gpu_mem, max_gpu_mem=None, enforce_interval=None):
+        import threading
+        self.claim_id = claim_id
+        self.gpu_num = gpu_num
+        self.gpu_mem = gpu_mem
+        self.max_gpu_mem = max_gpu_mem
+        self.released = False
+        # Serializes updates to the state file between the caller and the enforcer thread
+        self.lock = threading.Lock()
+        self.enforcer = None
+        if enforce_interval:
+            self.enforcer = threading.Thread(target=self._enforce, args=(enforce_interval,))
+            self.enforcer.daemon = True
+            self.enforcer.start()
+
+    @property
+    def cuda_visible_devices(self):
+        '''Value for CUDA_VISIBLE_DEVICES.'''
+        return str(self.gpu_num)
+
+    def _enforce(self, interval):
+        # Same as the command wrapper: kill this process if it uses more than
+        # it claimed or if the claim is being preempted.
+        last_signal = None
+        while not self.released:
+            with self.lock:
+                if self.released:
+                    break
+                stake_info = read_update_stake_info()
+                claims = [claim for claim in stake_info.get('claims', []) if claim['claim_id'] == self.claim_id]
+                if claims:
+                    enforce_claim(stake_info, claims[0], os.getpid())
+                sig = preemption_signal(stake_info, self.claim_id)
+            if sig and sig != last_signal:
+                log('claim %s is being preempted, sending signal %d to process %d' % (self.claim_id, sig, os.getpid()))
+                last_signal = sig
+                os.kill(os.getpid(), sig)
+            time.sleep(interval)
 
+    def resize(self, gpu_mem, wait_time=0):
+        '''
+        Change the amount of memory claimed on the same GPU, waiting up to
+        wait_time seconds for it to free up if growing.  Growing claims can
+        wait on each other forever unless they were placed with max_gpu_mem,
+        and cannot grow past it.
+        Before shrinking, free the GPU memory (e.g., empty the allocator's
+        cache): raise ClaimError if this process still uses more than gpu_mem,
+        since the enforcer would kill it.
+        '''
+        if self.released:
+            raise ClaimError('Claim %s was already released' % self.claim_id)
+        gpu_mem = parse_size(str(gpu_mem))
+        if self.max_gpu_mem and gpu_mem > self.max_gpu_mem:
+            raise ClaimError('Cannot resize claim %s to %s, beyond its max_gpu_mem %s' % (self.claim_id, size_str(gpu_mem), size_str(self.max_gpu_mem)))
+        start_time = time.time()
+        first_time = True
+        while True:
+            with self.lock:
+                stake_info = read_update_stake_info()
+                process = find_process(stake_info, self.gpu_num, os.getpid())
+                if process and process['gpu_mem'] > gpu_mem:
+                    raise ClaimError('Cannot resize claim %s to %s while this process uses %s on GPU%s' % (self.claim_id, size_str(gpu_mem), size_str(process['gpu_mem']), self.gpu_num))
+                with StakeLock():
+                    refresh_claims(stake_info)
+                    claim = get_claim(stake_info, self.claim_id)
+                    old_gpu_mem = claim['gpu_mem']
+                    claim['gpu_mem'] = gpu_mem
+                    # Growing must not eat into the room that the other claims
+                    # on this GPU were placed with (counting this one at its new size).
+                    total_gpu_mem = stake_info['gpu_info'][self.gpu_num]['total_gpu_mem']
+                    fits = gpu_mem <= old_gpu_mem or \
+                        (available_gpu_mem(stake_info, self.gpu_num) >= 0 and total_gpu_mem - get_max_claimed_gpu_mem(stake_info, self.gpu_num) >= 0)
+                    if fits:
+                        write_stake_info(stake_info)
+                if fits:
+                    self.gpu_mem = gpu_mem
+                    log('claim %s resized from %s to %s on GPU%s' % (self.claim_id, size_str(old_gpu_mem), size_str(gpu_mem), self.gpu_num))
+                    return
+            if time.time() - start_time >= wait_time:
+                raise ClaimError('Failed to resize claim %s to %s on GPU%s' % (self.claim_id, size_str(gpu_mem), self.gpu_num))
+            if first_time:
+                log('Waiting for something to free up...')
+                first_time = False
+            time.sleep(1)
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+            with StakeLock():
+                stake_info = read_stake_info()
+                stake_info['claims'] = [claim for claim in stake_info.get('claims', []) if claim['claim_id'] != self.claim_id]
+                write_stake_info(stake_info)
+        log('claim %s released' % self.claim_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def claim(gpu_mem='2g', max_gpu_mem=None, wait_time=0, base_dir=None, enforce_interval=1, priority='normal', grace_period=DEFAULT_GRACE_PERIOD):
+    '''
+    Claim gpu_mem (bytes or e.g., '20g') on some GPU for the calling process,
+    waiting up to wait_time seconds for it to free up.
+    If the claim will be resized up to max_gpu_mem, it is put on a GPU where
+    it can grow alongside the other claims that expect to grow.
+    A normal claim without max_gpu_mem that does not fit preempts preemptible
+    claims, giving them grace_period seconds to exit, if wait_time is long
+    enough to see that through.
+    Unless enforce_interval is None, a background thread kills this process
+    if it uses more than it claimed or if it is preempted (like the command
+    wrapper); install a SIGTERM handler to clean up when preempted.
+    Return a Claim; raise ClaimError if nothing is available.
+    '''
+    if base_dir is not None or stake_path is None:
+        init_stake_path(base_dir or DEFAULT_BASE_DIR)
+    gpu_mem = parse_size(str(gpu_mem))
+    if max_gpu_mem is not None:
+        max_gpu_mem = parse_size(str(max_gpu_mem))
+    if priority not in PRIORITIES:
+        raise ValueError('Invalid priority: %s, expected one of %s' % (priority, ', '.join(PRIORITIES)))
+    claim_id, stake_info = wait_for_claim(gpu_mem, list(sys.argv), wait_time, max_gpu_mem=max_gpu_mem, priority=priority, grace_period=grace_period)
+    if not claim_id:
+        raise ClaimError('Failed to claim %s' % size_str(gpu_mem))
+    gpu_num = get_claim(stake_info, claim_id)['gpu_num']
+    return Claim(claim_id, gpu_num, gpu_mem, max_gpu_mem, enforce_interval)
+
+############################################################
+
+def do_create():
+    # Claim some resources
+    claim_id, stake_info = wait_for_claim(parse_size(args.gpu_mem), args.command, args.wait_time, priority=args.priority, grace_period=args.grace_period)
     if not claim_id:
         log('Failed to claim resources')
         sys.exit(1)
@@ -349,8 +860,168 @@ def do_create():
     # Run the command
     run_command(claim_id, stake_info)
 
+def read_batch_file(path):
+    '''
+    Each line is <gpu_mem> <command>; blank lines and lines starting with # are skipped.
+    Return a list of jobs; exit if a line is malformed.
+    '''
+    jobs = []
+    for line_num, line in enumerate(open(path), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError('missing command')
+            gpu_mem, command = fields[0], fields[1]
+            gpu_mem = parse_size(gpu_mem)
+        except ValueError as e:
+            log('%s:%d: expected <gpu_mem> <command> (%s): %s' % (path, line_num, e, line))
+            sys.exit(1)
+        jobs.append({'index': len(jobs), 'gpu_mem': gpu_mem, 'command': command})
+    return jobs
+
+def do_batch():
+    '''
+    Run all the jobs in the batch file under this one process: on every tick,
+    take a single sample, enforce the claims of the running jobs, and start
+    as many waiting jobs as fit.  Jobs that get preempted are run again.
+    Jobs that cannot fit on any GPU, or that wait longer than --wait-time,
+    are recorded as failed.
+    '''
+    import subprocess
+
+    jobs = read_batch_file(args.batch)
+    log('Read %d jobs from %s' % (len(jobs), args.batch))
+    waiting = list(jobs)
+    running = []
+    start_time = time.time()
+    for job in jobs:
+        job['queue_time'] = start_time
+        job['reservation_id'] = generate_claim_id()
+
+    def fail_job(job, error):
+        job.update({'exitcode': None, 'time': 0, 'error': error})
+        waiting.remove(job)
+        log('Job %d failed: %s' % (job['index'], error))
+        if args.priority == 'normal':
+            cancel_reservation(stake_info, job['reservation_id'])
+
+    def end_attempt(job):
+        # Charge the attempt (finished or preempted) for its share of the GPU
+        job['gpu_hours'] = job.get('gpu_hours', 0) + (time.time() - job['start_time']) * job['gpu_fraction'] / 3600
+
+    def output_stats():
+        finished_jobs = [job for job in jobs if 'exitcode' in job]
+        stats = {
+            'jobs': [dict((k, v) for k, v in job.items() if k != 'popen') for job in jobs],
+            'summary': {
+                'num_jobs': len(jobs),
+                'num_finished': len(finished_jobs),
+                'num_failed': len([job for job in finished_jobs if job['exitcode'] != 0]),
+                'makespan': time.time() - start_time,
+                'gpu_hours': sum(job.get('gpu_hours', 0) for job in jobs),
+            },
+        }
+        if args.stats_file:
+            with open(args.stats_file, 'w') as f:
+                print(json.dumps(stats), file=f)
+        return stats
+
+    first = True
+    while waiting or running:
+        if not first:
+            try:
+                time.sleep(1)
+            except KeyboardInterrupt:
+                log('Got Ctrl+C, killing %d running jobs' % len(running))
+                for job in running:
+                    job['popen'].terminate()
+                waiting = []
+        first = False
+
+        stake_info = read_update_stake_info()
+
+        # Reap finished jobs and enforce the claims of the others
+        for job in list(running):
+            p = job['popen']
+            if p.poll() is not None and job['preempt_signal']:
+                log('Job %d (pid %d) was preempted after %ds, requeuing' % (job['index'], p.pid, time.time() - job['start_time']))
+                job['num_preemptions'] = job.get('num_preemptions', 0) + 1
+                end_attempt(job)
+                running.remove(job)
+                waiting.insert(0, job)
+                job['queue_time'] = time.time()
+                continue
+            if p.poll() is not None:
+                job['exitcode'] = p.returncode
+                job['time'] = time.time() - job['start_time']
+                end_attempt(job)
+                running.remove(job)
+                log('Job %d (pid %d) finished (exitcode %d, time %ds, max_gpu_mem %s)' % (job['index'], p.pid, p.returncode, job['time'], size_str(job['max_gpu_mem'])))
+                continue
+            process = enforce_claim(stake_info, job['claim'], p.pid)
+            if process:
+                job['max_gpu_mem'] = max(job['max_gpu_mem'], process['gpu_mem'])
+            sig = preemption_signal(stake_info, job['claim']['claim_id'])
+            if sig and sig != job['preempt_signal']:
+                log('Job %d is being preempted, sending signal %d to process %d' % (job['index'], sig, p.pid))
+                os.kill(p.pid, sig)
+                job['preempt_signal'] = sig
+
+        # Start as many waiting jobs as fit
+        max_total_gpu_mem = max([info['total_gpu_mem'] for info in stake_info['gpu_info'].values()] or [0])
+        preempted = False
+        for job in list(waiting):
+            if job['gpu_mem'] > max_total_gpu_mem:
+                fail_job(job, 'needs %s, but the largest GPU has %s' % (size_str(job['gpu_mem']), size_str(max_total_gpu_mem)))
+                continue
+            if time.time() - job['queue_time'] >= args.wait_time:
+                fail_job(job, 'waited %ds for resources' % (time.time() - job['queue_time']))
+                continue
+            claim_id = make_claim(stake_info, job['gpu_mem'], [job['command']], priority=args.priority, reservation_id=job['reservation_id'])
+            if not claim_id:
+                # Make room for (only) the first job that does not fit
+                if args.priority == 'normal' and not preempted and can_wait_for_preemption(job['queue_time'] + args.wait_time, args.grace_period):
+                    preempted = preempt_claims(stake_info, job['gpu_mem'], args.grace_period, job['reservation_id'])
+                continue
+            claim = get_claim(stake_info, claim_id)
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(claim['gpu_num']))
+            p = subprocess.Popen(['bash', '-c', job['command']], env=env)
+            log('Job %d running as pid %d: %s' % (job['index'], p.pid, job['command']))
+            claim = update_claim(stake_info, claim_id, pid=p.pid)
+            gpu_fraction = float(job['gpu_mem']) / stake_info['gpu_info'][claim['gpu_num']]['total_gpu_mem']
+            job.update({'claim': claim, 'popen': p, 'start_time': time.time(), 'max_gpu_mem': 0, 'preempt_signal': None, 'gpu_fraction': gpu_fraction})
+            job['wait_time'] = job['start_time'] - start_time
+            waiting.remove(job)
+            running.append(job)
+
+        output_stats()
+
+    summary = output_stats()['summary']
+    log('Batch finished: %d/%d jobs failed, makespan %ds, %.2f GPU-hours' % (summary['num_failed'], summary['num_jobs'], summary['makespan'], summary['gpu_hours']))
+    sys.exit(1 if summary['num_failed'] > 0 else 0)
+
+def read_cached_stake_info(max_age):
+    '''
+    Return the last sample if it is at most max_age seconds old, otherwise None.
+    Does not modify the state file.
+    '''
+    stake_info = read_stake_info()
+    sample_time = stake_info.get('gpu_info_time')
+    if sample_time is None or time.time() - sample_time > max_age:
+        return None
+    # Claims whose processes are gone are not shown
+    stake_info['claims'] = [claim for claim in stake_info.get('claims', []) if claim_exists(claim)]
+    return stake_info
+
 def do_info():
-    stake_info = read_update_stake_info()
+    stake_info = None
+    if args.cached is not None:
+        stake_info = read_cached_stake_info(args.cached)
+    if stake_info is None:
+        stake_info = read_update_stake_info()
     table = []
     table.append(['gpu', 'claimed', 'used', 'total', 'available'])
     for gpu_num in sorted(stake_info['gpu_info'].keys()):
@@ -376,7 +1047,8 @@ def do_info():
                     used_gpu_mem_str = size_str(process['gpu_mem'])
                     claimed_processes.append(process)
                     break
-            table.append([gpu_num, size_str(claim['gpu_mem']), used_gpu_mem_str, 'RUN %s (pid %s)' % (' '.join(claim['command']), claim['pid'])])
+            status = 'RUN' if claim.get('priority', 'normal') == 'normal' else claim['priority'].upper()
+            table.append([gpu_num, size_str(claim['gpu_mem']), used_gpu_mem_str, '%s %s (pid %s)' % (status, ' '.join(claim['command']), claim['pid'])])
 
         # Print out rogue processes
         for process in info.get('processes', []):
@@ -389,18 +1061,25 @@ def do_info():
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-b', '--base-dir', help='Directory where all the claims are stored', default='/u/nlp/machine-info/stake/var')
+    parser.add_argument('-b', '--base-dir', help='Directory where all the claims are stored', default=DEFAULT_BASE_DIR)
     parser.add_argument('-g', '--gpu-mem', help='Amount of GPU memory (e.g., 3, 3k, 3m, 3g)', default='2g')
     parser.add_argument('-s', '--stats-file', help='File to output stats about the execution')
     parser.add_argument('-w', '--wait-time', type=int, help='Number of seconds to wait for a free resource', default=10000000)
+    parser.add_argument('--priority', choices=PRIORITIES, help='Normal claims preempt preemptible claims when they do not fit', default='normal')
+    parser.add_argument('--grace-period', type=int, help='Number of seconds preempted commands get to exit before being killed', default=DEFAULT_GRACE_PERIOD)
+    parser.add_argument('--cached', type=float, metavar='SECONDS', help='Print information from the last sample if it is at most this many seconds old instead of running nvidia-smi')
+    parser.add_argument('--batch', help='File with one <gpu_mem> <command> per line to run as many at a time as fit')
     parser.add_argument('command', nargs='*')
     args = parser.parse_args()
 
-    hostname = socket.gethostbyaddr(socket.gethostname())[0].split('.')[0]
-    stake_path = os.path.join(args.base_dir, hostname + '.json')
+    init_stake_path(args.base_dir)
     log('state path: %s' % stake_path)
 
-    if args.command:
+    if args.batch:
+        if args.command:
+            parser.error('--batch cannot be combined with a command')
+        do_batch()
+    elif args.command:
         do_create()
     else:
         do_info()
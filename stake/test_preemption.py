@@ -0,0 +1,92 @@
+'''
+Checks preemption end to end on fake GPUs (see STAKE_FAKE_GPUS in stake.py).
+
+    python -m pytest stake/test_preemption.py
+'''
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from stake import stake
+
+GRACE_PERIOD = 2
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def wait_for(condition, timeout):
+    end_time = time.time() + timeout
+    while not condition():
+        assert time.time() < end_time, 'Timed out'
+        time.sleep(0.2)
+
+def test_normal_claim_preempts_batch(tmp_path):
+    base_dir = str(tmp_path)
+    env = dict(os.environ, STAKE_FAKE_GPUS='1x12g', STAKE_HOSTNAME='test')
+    stake_args = [sys.executable, stake.__file__.replace('.pyc', '.py'), '-b', base_dir]
+    state_path = os.path.join(base_dir, 'test.json')
+
+    # Fill up the GPU with preemptible jobs that ignore SIGTERM, so that
+    # they only go away when they are killed at the deadline.
+    batch_path = os.path.join(base_dir, 'batch.txt')
+    with open(batch_path, 'w') as f:
+        for _ in range(2):
+            print('6g trap "" TERM; sleep 60', file=f)
+    batch_stats_path = os.path.join(base_dir, 'batch-stats.json')
+    batch = subprocess.Popen(stake_args + ['--priority', 'preemptible', '-s', batch_stats_path, '--batch', batch_path], env=env)
+    try:
+        wait_for(lambda: os.path.exists(state_path) and len(read_json(state_path)['claims']) == 2, 10)
+
+        # The normal claim records when it started and the state of the host then
+        out_path = os.path.join(base_dir, 'out.json')
+        command = 'import json, time; info = json.load(open(%r)); json.dump({"time": time.time(), "info": info}, open(%r, "w"))' % (state_path, out_path)
+        launch_time = time.time()
+        exitcode = subprocess.call(stake_args + ['-g', '8g', '-w', '30', '--grace-period', str(GRACE_PERIOD), '--', sys.executable, '-c', command], env=env)
+        assert exitcode == 0
+        out = read_json(out_path)
+
+        # Preemption freed room within the grace period (plus a few ticks)
+        # and the normal claim was placed
+        assert out['time'] - launch_time < GRACE_PERIOD + 4
+        claims = out['info']['claims']
+        assert [claim['priority'] for claim in claims] == ['normal']
+        assert claims[0]['gpu_mem'] == stake.parse_size('8g')
+
+        # The reservation was dropped once the claim was placed
+        assert out['info']['reservations'] == []
+
+        # The preempted jobs were requeued
+        wait_for(lambda: sum(job.get('num_preemptions', 0) for job in read_json(batch_stats_path)['jobs']) == 2, 5)
+        assert batch.poll() is None
+    finally:
+        batch.terminate()
+        batch.wait()
+
+def test_no_reservation_without_preemption(tmp_path, monkeypatch):
+    monkeypatch.setenv('STAKE_FAKE_GPUS', '1x12g')
+    monkeypatch.setenv('STAKE_HOSTNAME', 'test')
+    base_dir = str(tmp_path)
+
+    # Only fails because of max_gpu_mem, which preempting does not help with
+    c = stake.claim(gpu_mem='2g', max_gpu_mem='8g', base_dir=base_dir, enforce_interval=None)
+    try:
+        try:
+            stake.claim(gpu_mem='2g', max_gpu_mem='8g', wait_time=GRACE_PERIOD + 3, base_dir=base_dir, grace_period=GRACE_PERIOD, enforce_interval=None)
+            assert False, 'Expected ClaimError'
+        except stake.ClaimError:
+            pass
+        stake_info = stake.read_update_stake_info()
+        assert stake_info['reservations'] == []
+
+        # Nothing preemptible to make room with, whether or not the memory
+        # is there already
+        for gpu_mem in ('2g', '12g'):
+            assert not stake.preempt_claims(stake_info, stake.parse_size(gpu_mem), GRACE_PERIOD, stake.generate_claim_id())
+            assert stake.read_update_stake_info()['reservations'] == []
+    finally:
+        c.release()